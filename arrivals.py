@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
 
 from pathlib import Path
-from datetime import datetime
-from threading import Event
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import monotonic, time as time_module
+from urllib.parse import urlsplit
+from concurrent import futures
+from email.utils import formatdate, parsedate_to_datetime
 from gtfs_helpers import *
-import shutil
+from feed_log import append_cycle, read_cycles
+from metrics import record, set_gauge, timed, prometheus_text, write_metrics_file
+from board_server import (
+    BoardState,
+    compile_template,
+    render_template,
+    start_board_server,
+)
+import os
+import zipfile
 import signal
 import subprocess
 import webbrowser
 import traceback
 import requests
 import argparse
+import cProfile
+import json
+import tracemalloc
 import bisect
+import hashlib
+import random
 
 """
 static GTFS:
@@ -62,55 +80,189 @@ marc_name_map = {
     "11976": "Perryville",
 }
 
+# route names in WMATA's static GTFS to the line codes GetPrediction uses
+metro_line_codes = {
+    "RED": "RD",
+    "ORANGE": "OR",
+    "BLUE": "BL",
+    "GREEN": "GR",
+    "YELLOW": "YL",
+    "SILVER": "SV",
+}
 
 exit_event = Event()
+# one keep-alive session per host so each refresh reuses the TLS connection
+sessions = {}
+# url: last full response, for ETag/Last-Modified conditional requests
+conditional_cache = {}
+# errors counts exceptions and 4xx/5xx responses alike, both are failed fetches
+fetch_stats = {"requests": 0, "bytes": 0, "not_modified": 0, "errors": 0}
+# providers are fetched concurrently so one slow feed can't hold up the render
+fetch_pool = futures.ThreadPoolExecutor(max_workers=4)
+# seconds each provider gets before the board renders without it
+fetch_deadlines = {"metro": 4, "marc": 4}
+# provider: fetch still running from an earlier cycle
+in_flight = {}
+network_recovery_lock = Lock()
+marc_path = "./mdotmta_gtfs_marc.zip"
+metro_path = "./metro_gtfs.zip"
+marc_static_gtfs_url = "https://feeds.mta.maryland.gov/gtfs/marc"
+# {"static": bundle from load_static} waiting to be swapped in by the render loop
+pending_static = {}
+# provider: {"digest", "changed", "cadence", "idle", "next", ...},
+# see observe_feed and schedule_poll
+poll_state = {}
+# longest a provider goes between fetches, from --max_poll
+max_poll_interval = 600
+# longest wait before retrying a failing provider, in seconds
+fetch_backoff_limit = 120
+# failed fetches in a row of one provider before --deploy restarts NetworkManager
+network_restart_after = 3
+# last good predictions are shown, marked stale, for this many seconds after
+# fetches start failing, then the board falls back to the schedule
+prediction_max_age = 600
+# departures this far away are on the board, in minutes
+board_window = 99
+# compiled template.html and the last page written to each board file
+board_template = None
+written_pages = {}
 
 
 def exit_handler(signal, frame):
     exit_event.set()
 
 
-def requester(url, method, allow_restart):
+def get_session(url):
+    host = urlsplit(url).netloc
+    if host not in sessions:
+        sessions[host] = requests.Session()
+    return sessions[host]
+
+
+def requester(url, method, allow_restart, conditional=False):
+    # with conditional, an unchanged resource (304) returns the previous response
     try:
+        session = get_session(url)
         if method == "get":
-            return requests.get(url, allow_redirects=True, timeout=3)
+            headers = {}
+            cached = conditional_cache.get(url) if conditional else None
+            if cached is not None:
+                if "etag" in cached.headers:
+                    headers["If-None-Match"] = cached.headers["etag"]
+                if "last-modified" in cached.headers:
+                    headers["If-Modified-Since"] = cached.headers["last-modified"]
+            resp = session.get(url, allow_redirects=True, timeout=3, headers=headers)
+            fetch_stats["requests"] += 1
+            if resp.status_code == 304 and cached is not None:
+                fetch_stats["not_modified"] += 1
+                return cached
+            fetch_stats["bytes"] += len(resp.content)
+            if not resp.ok:
+                fetch_stats["errors"] += 1
+            if conditional and resp.ok:
+                conditional_cache[url] = resp
+            return resp
         elif method == "head":
-            return requests.head(url, allow_redirects=True, timeout=3)
+            fetch_stats["requests"] += 1
+            return session.head(url, allow_redirects=True, timeout=3)
         else:
             return None
     except Exception:
+        fetch_stats["errors"] += 1
         if allow_restart:
-            exit_event.wait(10)
-            try:
-                subprocess.run(["sudo", "systemctl", "restart", "NetworkManager"])
-            except:
-                pass
+            start_network_recovery()
         else:
             print(traceback.format_exc())
     return None
 
 
-def download_unpack_zip(url, local_path):
-    # default to only downloading the GTFS zip file between daily board startup time and 8 am
-    gtfs_modified = datetime.today().replace(hour=8).timestamp()
-    resp = requester(url, "head", False)
-    if hasattr(resp, "headers") and "last-modified" in resp.headers:
-        last_modified = resp.headers["last-modified"]
-        # set to true last-modified time if available
-        gtfs_modified = datetime.strptime(
-            last_modified, "%a, %d %b %Y %H:%M:%S %Z"
-        ).timestamp()
-    if (
-        not Path(local_path).exists()
-        or Path(local_path).stat().st_mtime < gtfs_modified
-    ):
-        resp = requester(url, "get", False)
-        if resp:
-            temp_path = Path("./temp.zip")
+def recover_network():
+    try:
+        exit_event.wait(10)
+        if not exit_event.is_set():
+            subprocess.run(["sudo", "systemctl", "restart", "NetworkManager"])
+    except:
+        pass
+    finally:
+        network_recovery_lock.release()
+
+
+def start_network_recovery():
+    # restarts NetworkManager in the background, at most one restart at a time
+    if network_recovery_lock.acquire(blocking=False):
+        Thread(target=recover_network, daemon=True).start()
+
+
+def fetch_provider(provider, url, allow_restart):
+    with timed(f"fetch_{provider}"):
+        return requester(url, "get", allow_restart, True)
+
+
+def fetch_providers(urls, allow_restart):
+    # urls is {provider: url}, returns {provider: response or None}.
+    # A fetch that misses its deadline keeps running and is picked up next cycle
+    # instead of starting another request to the same provider. One that already
+    # finished by then is thrown away, its response could be minutes old.
+    started = monotonic()
+    for provider, url in urls.items():
+        if provider in in_flight and in_flight[provider].done():
+            del in_flight[provider]
+        if provider not in in_flight:
+            in_flight[provider] = fetch_pool.submit(
+                fetch_provider, provider, url, allow_restart
+            )
+    responses = {}
+    for provider in urls:
+        remaining = fetch_deadlines.get(provider, 4) - (monotonic() - started)
+        try:
+            responses[provider] = in_flight[provider].result(timeout=max(remaining, 0))
+        except futures.TimeoutError:
+            responses[provider] = None
+            continue
+        del in_flight[provider]
+    return responses
+
+
+def download_gtfs_zip(url, zip_path):
+    # Conditional GET of a static GTFS zip, streamed to disk in chunks.
+    # The zip is read in place by the loader, nothing is extracted.
+    zip_path = Path(zip_path)
+    headers = {}
+    if zip_path.exists():
+        headers["If-Modified-Since"] = formatdate(zip_path.stat().st_mtime, usegmt=True)
+    temp_path = Path(f"{zip_path}.part")
+    try:
+        with get_session(url).get(
+            url, allow_redirects=True, timeout=10, headers=headers, stream=True
+        ) as resp:
+            fetch_stats["requests"] += 1
+            if resp.status_code == 304:
+                fetch_stats["not_modified"] += 1
+                return
+            resp.raise_for_status()
+            if zip_path.exists():
+                # for servers that ignore If-Modified-Since
+                # default to only downloading the GTFS zip file between daily board startup time and 8 am
+                gtfs_modified = datetime.today().replace(hour=8).timestamp()
+                if "last-modified" in resp.headers:
+                    # set to true last-modified time if available
+                    gtfs_modified = parsedate_to_datetime(
+                        resp.headers["last-modified"]
+                    ).timestamp()
+                if zip_path.stat().st_mtime >= gtfs_modified:
+                    return
             with open(temp_path, "wb") as out:
-                out.write(resp.content)
-            shutil.unpack_archive(temp_path, local_path)
-            temp_path.unlink()
+                for chunk in resp.iter_content(chunk_size=1 << 16):
+                    fetch_stats["bytes"] += len(chunk)
+                    out.write(chunk)
+        # only replace the old feed once the new one is complete and readable
+        if zipfile.is_zipfile(temp_path):
+            os.replace(temp_path, zip_path)
+    except Exception:
+        fetch_stats["errors"] += 1
+        print(traceback.format_exc())
+    finally:
+        temp_path.unlink(missing_ok=True)
 
 
 def decrypt_metro_api():
@@ -135,21 +287,27 @@ def decrypt_metro_api():
     return key
 
 
-def get_metro_rows(realtime):
-    if realtime is None:
-        return [
-            '<div class="service-name"><img src="images/WMATA_Metro_Logo.svg" class="metro-logo">Network error</div>'
-        ]
-    data = realtime.json()
+def get_metro_departures(data, location_code=None, age_minutes=0):
+    # {DestinationName: [(minutes, line)]} sorted by minutes, None on network error.
+    # data is the parsed GetPrediction json, location_code picks one station's
+    # trains when several were requested at once, and may itself be a "," separated
+    # list for transfer stations with a code per level (A01,C01).
+    # age_minutes is how long ago data was fetched, taken off each prediction so
+    # render-only ticks don't go stale
+    if data is None:
+        return None
     filtered = []
+    location_codes = set(location_code.split(",")) if location_code else None
     if "Trains" not in data:
-        return []
+        return {}
     for entry in data.get("Trains", []):
         if (
-            "Min" in entry
+            (location_codes is None or entry.get("LocationCode") in location_codes)
+            and "Min" in entry
             and "DestinationName" in entry
             and entry["DestinationName"] not in ["No Passenger", "Train"]
             and entry["Min"] not in ["ARR", "BRD", "DLY", ""]
+            and int(entry["Min"]) > age_minutes
         ):
             filtered.append(entry)
     by_dest = {}
@@ -157,10 +315,48 @@ def get_metro_rows(realtime):
         key = entry["DestinationName"]
         if key in by_dest:
             bisect.insort_right(
-                by_dest[key], (int(entry["Min"]), entry["Line"]), key=(lambda x: x[0])
+                by_dest[key],
+                (int(entry["Min"]) - age_minutes, entry["Line"]),
+                key=(lambda x: x[0]),
             )
         else:
-            by_dest[key] = [(int(entry["Min"]), entry["Line"])]
+            by_dest[key] = [(int(entry["Min"]) - age_minutes, entry["Line"])]
+    return by_dest
+
+
+def get_metro_scheduled(metro_info, metro_sched, dt):
+    # {trip_headsign: [(minutes, line)]} from the WMATA static GTFS for the next
+    # 99 minutes, in the same shape as get_metro_departures
+    if metro_info is None or metro_sched is None:
+        return {}
+    sched = get_departures_in_window(
+        metro_info, metro_sched, dt, dt + timedelta(minutes=99)
+    )
+    by_dest = {}
+    for (headsign, route), times in sched.items():
+        line = metro_line_codes.get(route.upper(), route)
+        for x in times:
+            # ceiling division so trains less than a minute away round up to 1
+            minutes = int(-((x.arrival_time - dt).total_seconds() // -60))
+            if 0 < minutes < 100:
+                by_dest.setdefault(headsign, []).append((minutes, line))
+    for times in by_dest.values():
+        times.sort(key=(lambda x: x[0]))
+    return by_dest
+
+
+def get_metro_rows(by_dest, scheduled=None, stale=False):
+    # scheduled (from get_metro_scheduled) stands in when predictions are unavailable
+    # (by_dest is None), an empty by_dest means GetPrediction had no trains for us.
+    # stale marks predictions kept from an earlier fetch
+    realtime = True
+    if by_dest is None and scheduled:
+        by_dest = scheduled
+        realtime = False
+    if by_dest is None:
+        return [
+            '<div class="service-name"><img src="images/WMATA_Metro_Logo.svg" class="metro-logo">Network error</div>'
+        ]
     rows = []
     if not by_dest:
         rows.append(
@@ -168,106 +364,573 @@ def get_metro_rows(realtime):
         )
     for key, val in by_dest.items():
         times_str = [x[0] for x in val]
+        times_class = "times"
+        if realtime:
+            times_str = str(times_str[:2])[1:-1]
+            if stale:
+                times_class = "times stale"
+        else:
+            times_str = ", ".join(f"<b><i>{x}</i></b>" for x in times_str[:2])
         rows.append(
-            f'<div class="service-name"><div class="clear-backer"><img src="images/WMATA_Metro_Logo.svg" class="metro-logo"><div class="metro-bullet {val[0][1]}">{val[0][1]}</div></div>{key}</div><div class="times">{str(times_str[:2])[1:-1]}</div>'
+            f'<div class="service-name"><div class="clear-backer"><img src="images/WMATA_Metro_Logo.svg" class="metro-logo"><div class="metro-bullet {val[0][1]}">{val[0][1]}</div></div>{key}</div><div class="{times_class}">{times_str}</div>'
         )
     return rows
 
 
-def write_rows(rows):
-    with open("template.html", "r") as infile:
-        template = infile.read()
-    for i, row in enumerate(rows):
-        template = template.replace(f"Row {i}", row)
-    with open("DepartureBoard.html", "w") as outfile:
-        outfile.write(template)
+def write_rows(rows, path="DepartureBoard.html"):
+    # The template is compiled once, and the page is only rewritten when it changed.
+    # Written to a temp file and renamed so the browser never reads a partial page.
+    global board_template
+    if board_template is None:
+        board_template = compile_template("template.html")
+    with timed("write"):
+        page = render_template(board_template, rows)
+        if page == written_pages.get(path):
+            return
+        with open(f"{path}.tmp", "w") as outfile:
+            outfile.write(page)
+        os.replace(f"{path}.tmp", path)
+        written_pages[path] = page
 
 
-def main(args):
-    marc_path = "./mdotmta_gtfs_marc"
-    metro_path = "./metro_gtfs"
-    if args.marc_code:
-        marc_static_gtfs_url = "https://feeds.mta.maryland.gov/gtfs/marc"
-        download_unpack_zip(marc_static_gtfs_url, marc_path)
-        marc_info = read_gtfs_files(marc_path)
-        marc_sched = get_gtfs_schedule(marc_info, args.marc_code)
-
-    if args.metro_code:
-        metro_key = decrypt_metro_api()
-        # metro_static_gtfs_url = (
-        #     f"https://api.wmata.com/gtfs/rail-gtfs-static.zip?api_key={metro_key}"
-        # )
-        # download_unpack_zip(metro_static_gtfs_url, metro_path)
-        # metro_info = read_gtfs_files(metro_path)
-        # metro_sched = get_gtfs_schedule(metro_info, args.marc_code)
+def get_marc_rows(realtime, marc_code, marc_info, marc_sched, stale=False):
+    # returns (rows, departures) where departures back the json endpoint,
+    # stale marks realtime kept from an earlier fetch
+    marc_arr = combine_realtime_with_sched(realtime, marc_code, marc_info, marc_sched)
+    marc_rows = []
+    departures = []
+    for entry in marc_arr:
+        dest_name = (
+            marc_name_map[entry["dest_id"]]
+            if entry["dest_id"] in marc_name_map
+            else marc_info["stops"][entry["dest_id"]]["stop_name"]
+        )
+        minutes_str = ""
+        max_times = 2  # how many trains to the same destination we'll include
+        times_class = "times"
+        for time in entry["times"]:
+            if max_times <= 0:
+                break
+            minutes = time["arrival_time"]
+            if time["realtime"] and stale:
+                times_class = "times stale"
+            if time["realtime"]:
+                minutes_str += f"{minutes}, "
+            else:
+                minutes_str += f"<b><i>{minutes}</i></b>, "
+            max_times -= 1
+        marc_rows.append(
+            f'<div class="service-name"><div class="white-backer"><img src="images/MARC_train.svg.png" class="marc-logo"></div>{dest_name}</div><div class="{times_class}">{minutes_str[:-2]}</div>'
+        )
+        departures.append({"dest": dest_name, "times": entry["times"], "stale": stale})
+
+    if not marc_rows:  # no trains are coming within the next 99 minutes
+        next_marc_time = get_next_scheduled(marc_info, marc_sched, current_time())
+        if next_marc_time:
+            # time_str = next_marc_time.strftime("%A, %b %-d at %-I:%M %p")
+            time_str = next_marc_time.strftime("%A at %-I:%M %p")
+            marc_rows.append(
+                f'<div class="service-name"><div class="white-backer"><img src="images/MARC_train.svg.png" class="marc-logo"></div></div><div class="times"><i>Resumes {time_str}</i></div>'
+            )
+    return marc_rows, departures
+
+
+def render_station(station, metro_data, marc_resp, static, metro_age=0, stale=()):
+    # returns (rows, departures) for one station's board,
+    # static holds the loaded GTFS info and schedules for each agency,
+    # metro_age is the minutes since metro_data was fetched
+    # and stale the providers whose latest fetch failed
+    metro_rows = []
+    marc_rows = []
+    departures = {"metro": [], "marc": []}
+    if station["metro_code"]:
+        metro_departures = get_metro_departures(
+            metro_data, station["metro_code"], metro_age
+        )
+        scheduled = None
+        if metro_departures is None:
+            scheduled = get_metro_scheduled(
+                static["metro_info"],
+                static["metro_scheds"].get(station["metro_code"]),
+                current_time(),
+            )
+        metro_rows = get_metro_rows(metro_departures, scheduled, "metro" in stale)
+        departures["metro"] = [
+            {
+                "dest": dest,
+                "line": times[0][1],
+                "times": [x[0] for x in times],
+                "realtime": metro_departures is not None,
+                "stale": metro_departures is not None and "metro" in stale,
+            }
+            for dest, times in (metro_departures or scheduled or {}).items()
+        ]
+    if station["marc_code"]:
+        marc_rows, departures["marc"] = get_marc_rows(
+            marc_resp,
+            station["marc_code"],
+            static["marc_info"],
+            static["marc_scheds"][station["marc_code"]],
+            "marc" in stale,
+        )
+
+    # Purple line always gets bottom row
+    # MARC gets at most 3
+    # Metro gets the rest
+    # Blank lines for the rest
+    rows = metro_rows[: (5 - len(marc_rows[:3]))] + marc_rows[:3]
+    blank_row = '<div class="service-name"></div>'
+    purple_row = '<div class="service-name"><div class="white-backer"><img src="images/MTA_Purple_Line_logo.svg.png" class="purple-line-logo"></div></div><div class="times"><i>Coming 2028</i></div>'
+    rows += [blank_row] * (5 - len(rows))
+    rows.append(purple_row)
+    return rows, departures
+
+
+def feed_timestamp(provider, resp):
+    # FeedHeader.timestamp of a GTFS-RT response, None for other feeds or if unset
+    if provider != "marc" or not resp:
+        return None
+    try:
+        return parse_realtime_feed(resp.content).header.timestamp or None
+    except Exception:
+        return None
+
+
+def observe_feed(provider, resp, now, feed_time=None):
+    # Tracks how often a feed's content actually changes, as a moving average of the
+    # time between changes: FeedHeader.timestamp deltas when the feed has them
+    # (feed_time) when it moved, else the monotonic time between fetches that came
+    # back different.
+    # Fetches only ever see changes as far apart as the polling, so nothing is learned
+    # while the feed is idle (see schedule_poll), and a change on two fetches in a row
+    # means it updates faster than it's polled, so the cadence is halved instead.
+    state = poll_state.setdefault(
+        provider,
+        {
+            "digest": None,
+            "changed": None,
+            "feed_time": None,
+            "changed_last": False,
+            "cadence": None,
+            "idle": False,
+            "next": 0,
+        },
+    )
+    if resp is None:
+        return
+    digest = hashlib.sha1(resp.content).digest()
+    if digest == state["digest"]:
+        state["changed_last"] = False
+        return
+    if state["changed"] is not None and not state["idle"]:
+        gap = now - state["changed"]
+        if feed_time and state["feed_time"] and feed_time > state["feed_time"]:
+            gap = feed_time - state["feed_time"]
+        if gap > 0:
+            if state["cadence"] is None:
+                state["cadence"] = gap
+            elif state["changed_last"]:
+                state["cadence"] = min(state["cadence"], gap) / 2
+            else:
+                state["cadence"] = 0.7 * state["cadence"] + 0.3 * gap
+    state["digest"] = digest
+    state["changed"] = now
+    state["feed_time"] = feed_time
+    state["changed_last"] = True
+
+
+def schedule_poll(provider, now, refresh, ok, resume_in=None):
+    # Picks when provider is fetched next: half its observed update cadence, or after
+    # errors an exponential backoff with full jitter so a flaky link isn't retried in
+    # lockstep. With nothing on the board, resume_in is how many seconds until its
+    # next departure could reach the board, and the feed is idle until then.
+    # Coming back from idle, the cadence is relearned from every refresh.
+    # Always between refresh and max_poll_interval.
+    state = poll_state[provider]
+    interval = refresh
+    if not ok:
+        state["failures"] = state.get("failures", 0) + 1
+        backoff = min(refresh * 2 ** state["failures"], fetch_backoff_limit)
+        interval = random.uniform(refresh, max(backoff, refresh))
+    else:
+        state["failures"] = 0
+        if state["cadence"]:
+            interval = state["cadence"] / 2
+        if resume_in is not None and resume_in > interval:
+            interval = resume_in
+            state["idle"] = True
+        elif state["idle"]:
+            state.update(idle=False, cadence=None, changed=None, feed_time=None)
+            interval = refresh
+    interval = min(max(interval, refresh), max_poll_interval)
+    state["next"] = now + interval
+    set_gauge("poll_interval_seconds", round(interval, 1), feed=provider)
+
+
+def resume_in(provider, stations, shown, static):
+    # Seconds until provider's next scheduled departure at any station enters the
+    # board window, None if something is on the board for it now, or if there's no
+    # schedule to go by (the static feed didn't load or a station didn't resolve),
+    # since nothing shown then doesn't mean there's no service.
+    if shown[provider]:
+        return None
+    info = static[f"{provider}_info"]
+    scheds = [
+        static[f"{provider}_scheds"].get(code)
+        for code in {x[f"{provider}_code"] for x in stations if x[f"{provider}_code"]}
+    ]
+    if info is None or not all(scheds):
+        return None
+    now = current_time()
+    next_times = [get_next_scheduled(info, sched, now) for sched in scheds]
+    next_times = [x for x in next_times if x is not None]
+    if not next_times:
+        return max_poll_interval  # no service for the next week
+    until = (min(next_times) - now).total_seconds() - board_window * 60
+    return max(until, 0)
+
+
+def download_static(marc_codes, metro_codes, metro_key):
+    if marc_codes:
+        download_gtfs_zip(marc_static_gtfs_url, marc_path)
+    if metro_codes:
+        download_gtfs_zip(
+            f"https://api.wmata.com/gtfs/rail-gtfs-static.zip?api_key={metro_key}",
+            metro_path,
+        )
+
+
+def feed_version(path):
+    # gtfs_feed_version, or None for a zip that's missing or unreadable
+    try:
+        return gtfs_feed_version(path)
+    except Exception:
+        return None
+
+
+def load_static(marc_codes, metro_codes, previous=None, workers=1):
+    # Compiles the static GTFS zips on disk into the bundle render_station reads,
+    # which is only ever replaced whole. versions is {zip path: gtfs_feed_version}
+    # with None for a feed that failed to load, and a feed whose version matches
+    # previous is reused rather than compiled again.
+    # workers is how many processes parse stop_times when there's no compiled cache.
+    static = {
+        "marc_info": None,
+        "marc_scheds": {},
+        "metro_info": None,
+        "metro_scheds": {},
+        "versions": {},
+    }
+    old_versions = previous["versions"] if previous is not None else {}
+    if marc_codes:
+        version = gtfs_feed_version(marc_path)
+        if version == old_versions.get(marc_path):
+            static["marc_info"] = previous["marc_info"]
+            static["marc_scheds"] = previous["marc_scheds"]
+        else:
+            static["marc_info"], static["marc_scheds"] = load_gtfs_schedules(
+                marc_path, marc_codes, workers=workers
+            )
+        static["versions"][marc_path] = version
+
+    if metro_codes:
+        # WMATA's schedule is only a fallback for when GetPrediction fails,
+        # so the board still runs without it (or with the previous one)
+        static["versions"][metro_path] = None
+        try:
+            version = gtfs_feed_version(metro_path)
+            if version == old_versions.get(metro_path):
+                static["metro_info"] = previous["metro_info"]
+                static["metro_scheds"] = previous["metro_scheds"]
+            else:
+                static["metro_info"], static["metro_scheds"] = load_gtfs_schedules(
+                    metro_path, metro_codes, group_by="headsign", workers=workers
+                )
+            static["versions"][metro_path] = version
+        except Exception:
+            print(traceback.format_exc())
+            if previous is not None:
+                static["metro_info"] = previous["metro_info"]
+                static["metro_scheds"] = previous["metro_scheds"]
+    return static
 
-    while not exit_event.is_set():
-        metro_resp = None
-        marc_resp = None
-        if args.metro_code:
-            url = f"http://api.wmata.com/StationPrediction.svc/json/GetPrediction/{args.metro_code}?api_key={metro_key}"
-            metro_resp = requester(url, "get", args.deploy)
-        if args.marc_code:
-            url = "https://mdotmta-gtfs-rt.s3.amazonaws.com/MARC+RT/marc-tu.pb"
-            marc_resp = requester(url, "get", args.deploy)
 
+def reload_static(marc_codes, metro_codes, metro_key, previous, interval, workers):
+    # Background thread: every interval seconds, downloads any newer static feed and
+    # compiles it off the render thread, leaving it in pending_static to be swapped in.
+    # A feed that failed to load (version None) is tried again every time.
+    # Only one bundle is ever being built, so at most two are in memory at once.
+    # previous is the bundle loaded at startup.
+    while not exit_event.wait(interval):
         try:
-            metro_rows = get_metro_rows(metro_resp)
-            marc_arr = combine_realtime_with_sched(
-                marc_resp, args.marc_code, marc_info, marc_sched
+            download_static(marc_codes, metro_codes, metro_key)
+            if all(
+                x is not None and feed_version(path) == x
+                for path, x in previous["versions"].items()
+            ):
+                continue
+            with timed("reload"):
+                static = load_static(marc_codes, metro_codes, previous, workers)
+            if static["versions"] == previous["versions"]:
+                # only a retry of a feed that still doesn't load
+                continue
+            previous = static
+            pending_static["static"] = static
+            print("Reloaded static GTFS")
+        except Exception:
+            print(traceback.format_exc())
+
+
+def load_stations(args):
+    # Stations from --stations, or the single station given by --marc_code/--metro_code.
+    # The config is a json list like
+    # [{"name": "college_park", "marc_code": "12018-12015", "metro_code": "E09"}]
+    # and each station's board goes to DepartureBoard-<name>.html unless it has an "output"
+    if not args.stations:
+        return [
+            {
+                "name": "",
+                "marc_code": args.marc_code,
+                "metro_code": args.metro_code,
+                "output": "DepartureBoard.html",
+            }
+        ]
+    with open(args.stations, "r") as infile:
+        config = json.load(infile)
+    stations = []
+    for entry in config:
+        stations.append(
+            {
+                "name": entry["name"],
+                "marc_code": entry.get("marc_code"),
+                "metro_code": entry.get("metro_code"),
+                "output": entry.get("output", f"DepartureBoard-{entry['name']}.html"),
+            }
+        )
+    return stations
+
+
+def metrics_counters():
+    counters = {f"fetch_{key}": value for key, value in fetch_stats.items()}
+    counters.update({f"realtime_{key}": value for key, value in realtime_stats.items()})
+    return counters
+
+
+def board_metrics_text():
+    return prometheus_text(metrics_counters())
+
+
+def dump_profile(profiler):
+    # cProfile stats of the profiled cycles plus the largest tracemalloc allocation sites
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    profiler.dump_stats("profile.prof")
+    with open("profile_tracemalloc.txt", "w") as outfile:
+        for stat in snapshot.statistics("lineno")[:30]:
+            outfile.write(f"{stat}\n")
+    print("Wrote profile.prof and profile_tracemalloc.txt")
+
+
+def main(args):
+    stations = load_stations(args)
+    # every station shares one static feed load and one fetch of each realtime feed
+    marc_codes = list(dict.fromkeys(x["marc_code"] for x in stations if x["marc_code"]))
+    metro_codes = list(
+        dict.fromkeys(x["metro_code"] for x in stations if x["metro_code"])
+    )
+    metro_key = None
+    if metro_codes and not args.replay:
+        metro_key = decrypt_metro_api()
+    if not args.replay:
+        download_static(marc_codes, metro_codes, metro_key)
+    static = load_static(marc_codes, metro_codes, workers=args.workers)
+    if args.reload > 0 and not args.replay:
+        Thread(
+            target=reload_static,
+            args=(
+                marc_codes,
+                metro_codes,
+                metro_key,
+                static,
+                args.reload,
+                args.workers,
+            ),
+            daemon=True,
+        ).start()
+
+    board_states = {}
+    if args.serve:
+        # one port per station, counting up from --serve
+        for i, station in enumerate(stations):
+            board_states[station["output"]] = BoardState()
+            start_board_server(
+                args.serve + i, board_states[station["output"]], board_metrics_text
             )
-            marc_rows = []
-            for entry in marc_arr:
-                dest_name = (
-                    marc_name_map[entry["dest_id"]]
-                    if entry["dest_id"] in marc_name_map
-                    else marc_info["stops"][entry["dest_id"]]["stop_name"]
+
+    profiler = None
+    profiled_cycles = 0
+    if args.profile:
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+
+    global max_poll_interval
+    max_poll_interval = max(args.max_poll, args.refresh)
+    # a replay renders the captured cycles back to back instead of fetching
+    replay_cycles = read_cycles(args.replay) if args.replay else None
+    replay_start = monotonic()
+    replayed = []  # fetch times of the replayed cycles
+    # latest response from each provider, kept between fetches for render-only ticks
+    responses = {}
+    fetched_at = {}
+    stale = set()  # providers whose latest fetch failed
+    metro_data = None
+
+    while not exit_event.is_set():
+        cycle_start = monotonic()
+        if profiler:
+            profiler.enable()
+        if pending_static:
+            # swap in the reloaded feeds between renders, the old ones are freed
+            # once nothing refers to them
+            static = pending_static.pop("static")
+            forget_schedules()
+        if replay_cycles is not None:
+            cycle = next(replay_cycles, None)
+            if cycle is None:
+                break
+            fetch_time, fetched = cycle
+            virtual_clock["now"] = datetime.fromtimestamp(fetch_time)
+            replayed.append(fetch_time)
+        else:
+            urls = {}
+            if metro_codes:
+                # GetPrediction takes a comma separated list of stations
+                url = f"http://api.wmata.com/StationPrediction.svc/json/GetPrediction/{','.join(metro_codes)}?api_key={metro_key}"
+                urls["metro"] = url
+            if marc_codes:
+                urls["marc"] = (
+                    "https://mdotmta-gtfs-rt.s3.amazonaws.com/MARC+RT/marc-tu.pb"
                 )
-                minutes_str = ""
-                max_times = 2  # how many trains to the same destination we'll include
-                for time in entry["times"]:
-                    if max_times <= 0:
-                        break
-                    minutes = time["arrival_time"]
-                    if time["realtime"]:
-                        minutes_str += f"{minutes}, "
-                    else:
-                        minutes_str += f"<b><i>{minutes}</i></b>, "
-                    max_times -= 1
-                marc_rows.append(
-                    f'<div class="service-name"><div class="white-backer"><img src="images/MARC_train.svg.png" class="marc-logo"></div>{dest_name}</div><div class="times">{minutes_str[:-2]}</div>'
+            # only the feeds that are due, the other ticks just re-render
+            urls = {
+                provider: url
+                for provider, url in urls.items()
+                if poll_state.get(provider, {}).get("next", 0) <= cycle_start
+            }
+            fetched = {}
+            if urls:
+                # a single failure is left to the backoff, a run of them restarts the network
+                allow_restart = args.deploy and any(
+                    poll_state.get(provider, {}).get("failures", 0) + 1
+                    >= network_restart_after
+                    for provider in urls
                 )
-
-            if not marc_rows:  # no trains are coming within the next 99 minutes
-                next_marc_time = get_next_scheduled(
-                    marc_info, marc_sched, datetime.today()
+                with timed("fetch"):
+                    fetched = fetch_providers(urls, allow_restart)
+            if args.capture and fetched:
+                try:
+                    append_cycle(args.capture, time_module(), fetched)
+                except Exception:
+                    print(traceback.format_exc())
+            for provider, resp in fetched.items():
+                observe_feed(
+                    provider, resp, cycle_start, feed_timestamp(provider, resp)
                 )
-                if next_marc_time:
-                    # time_str = next_marc_time.strftime("%A, %b %-d at %-I:%M %p")
-                    time_str = next_marc_time.strftime("%A at %-I:%M %p")
-                    marc_rows.append(
-                        f'<div class="service-name"><div class="white-backer"><img src="images/MARC_train.svg.png" class="marc-logo"></div></div><div class="times"><i>Resumes {time_str}</i></div>'
+        ok = {}
+        for provider, resp in fetched.items():
+            ok[provider] = bool(resp)
+            if provider == "metro" and resp:
+                try:
+                    metro_data = resp.json()
+                except Exception:
+                    print(traceback.format_exc())
+                    ok[provider] = False
+            if ok[provider]:
+                responses[provider] = resp
+                fetched_at[provider] = current_time()
+                stale.discard(provider)
+            else:
+                # keep serving the last good response until it's too old
+                stale.add(provider)
+        for provider in list(stale):
+            age = (
+                current_time() - fetched_at.get(provider, datetime.min)
+            ).total_seconds()
+            if age > prediction_max_age and provider in responses:
+                del responses[provider]
+                if provider == "metro":
+                    metro_data = None
+        metro_age = 0
+        if "metro" in fetched_at:
+            metro_age = int(
+                (current_time() - fetched_at["metro"]).total_seconds() // 60
+            )
+
+        shown = {"metro": False, "marc": False}
+        for station in stations:
+            try:
+                with timed("render"):
+                    rows, departures = render_station(
+                        station,
+                        metro_data,
+                        responses.get("marc"),
+                        static,
+                        metro_age,
+                        stale,
                     )
+                for provider in shown:
+                    shown[provider] = shown[provider] or bool(departures[provider])
+                if args.serve:
+                    board_states[station["output"]].publish(rows, departures)
+                else:
+                    write_rows(rows, station["output"])
+                    if args.webbrowser:
+                        written_html = Path(station["output"]).absolute()
+                        webbrowser.open(
+                            f"file://{written_html}", new=0, autoraise=False
+                        )
+            except Exception:
+                print(traceback.format_exc())
 
-            # Purple line always gets bottom row
-            # MARC gets at most 3
-            # Metro gets the rest
-            # Blank lines for the rest
-            rows = metro_rows[: (5 - len(marc_rows[:3]))] + marc_rows[:3]
-            blank_row = '<div class="service-name"></div>'
-            purple_row = '<div class="service-name"><div class="white-backer"><img src="images/MTA_Purple_Line_logo.svg.png" class="purple-line-logo"></div></div><div class="times"><i>Coming 2028</i></div>'
-            rows += [blank_row] * (5 - len(rows))
-            rows.append(purple_row)
-            write_rows(rows)
-            written_html = Path("DepartureBoard.html").absolute()
-            if args.webbrowser:
-                webbrowser.open(f"file://{written_html}", new=0, autoraise=False)
-            if args.refresh > 0:
-                exit_event.wait(args.refresh)
-            else:
-                return
-        except Exception:
-            print(traceback.format_exc())
+        if replay_cycles is None:
+            for provider in fetched:
+                schedule_poll(
+                    provider,
+                    cycle_start,
+                    args.refresh,
+                    ok[provider],
+                    resume_in(provider, stations, shown, static),
+                )
+        record("cycle", monotonic() - cycle_start)
+        if parsed_realtime["feed"] is not None:
+            feed_time = parsed_realtime["feed"].header.timestamp
+            set_gauge(
+                "feed_age_seconds",
+                round(current_time().timestamp() - feed_time),
+                feed="marc",
+            )
+        if args.metrics:
+            write_metrics_file(args.metrics, metrics_counters())
+        if profiler:
+            profiler.disable()
+            profiled_cycles += 1
+            if profiled_cycles >= args.profile:
+                dump_profile(profiler)
+                profiler = None
+        if replay_cycles is not None:
+            continue
+        if args.refresh > 0:
+            exit_event.wait(args.refresh)
+        else:
+            return
+
+    if replayed:
+        virtual_clock["now"] = None
+        elapsed = monotonic() - replay_start
+        span = replayed[-1] - replayed[0]
+        print(
+            f"Replayed {len(replayed)} cycles spanning {timedelta(seconds=round(span))} in {elapsed:.2f} s ({span / max(elapsed, 1e-9):.0f}x real time)"
+        )
 
 
 if __name__ == "__main__":
@@ -288,7 +951,7 @@ if __name__ == "__main__":
         "--refresh",
         type=int,
         default=0,
-        help="Seconds between page refresh, 0 is no refresh",
+        help="Seconds between page refresh, 0 is no refresh. Feeds are fetched at most this often",
     )
     parser.add_argument(
         "--webbrowser",
@@ -302,5 +965,59 @@ if __name__ == "__main__":
         default=False,
         help="If systemctl commands should be allowed to run",
     )
+    parser.add_argument(
+        "--stations",
+        type=str,
+        default=None,
+        help="json file listing several stations to drive from one process, instead of --marc_code/--metro_code",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        default=0,
+        help="Serve the board on this localhost port and push row updates instead of writing DepartureBoard.html",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="Write per-stage timings and counters to this file in the Prometheus text format every refresh",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        default=0,
+        help="Capture cProfile and tracemalloc snapshots over this many refresh cycles",
+    )
+    parser.add_argument(
+        "--max_poll",
+        type=int,
+        default=600,
+        help="Most seconds between fetches of a feed that isn't changing or has nothing to show, --refresh for a fixed interval",
+    )
+    parser.add_argument(
+        "--reload",
+        type=int,
+        default=3600,
+        help="Seconds between checks for a new static GTFS feed, which is loaded in the background, 0 to only load at startup",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes to parse the static GTFS stop_times.txt with when it has to be compiled",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        default=None,
+        help="Append every raw realtime response to this gzip log for --replay",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Render the boards from a --capture log as fast as possible instead of fetching, using the static GTFS zips already on disk",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from gtfs_helpers import *
+from arrivals import get_metro_departures, get_metro_rows, write_rows
+from feed_log import RecordedResponse
+import arrivals
+import gtfs_helpers
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import zipfile
+
+"""
+Offline benchmarks for each stage of a board refresh, on synthetic feeds of
+configurable size. Nothing touches the network.
+
+./bench.py --trips 20000 --stops 30
+
+Each run is appended to bench_results.jsonl along with its feed size, and compared
+to the last run of the same size so regressions show up without a Pi.
+
+Stages:
+startup_cold     load_gtfs_schedule without a compiled cache
+startup_warm     load_gtfs_schedule from the compiled cache
+read_gtfs_files  streaming parse of the static feed
+read_gtfs_files_parallel  same with stop_times split across --workers processes
+get_gtfs_schedule
+build_day_view   yesterday's to tomorrow's departures, rebuilt at rollover
+get_departures_in_window  the board's lookback + 99 minute window
+build_next_index  week of departures get_next_scheduled bisects into
+get_next_scheduled  lookup once the index is built
+merge            parse + merge of a GTFS-RT feed with an entity per trip
+combine_realtime_with_sched
+get_metro_rows   WMATA GetPrediction json to rows
+write_rows
+"""
+
+platform_pair = "P_NB-P_SB"
+results_path = Path(__file__).with_name("bench_results.jsonl")
+
+
+def gtfs_time_str(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def write_synthetic_gtfs(path, n_trips, stops_per_trip, n_services, n_exceptions):
+    # Writes a static GTFS zip of one corridor of stops_per_trip stops with the
+    # board's platforms in the middle. Trips run both ways, some short turn, and
+    # start between 4 am and 1 am the next day.
+    # Returns {trip_id: [(stop_id, seconds)]} for generating matching realtime.
+    random.seed(n_trips)
+    today = datetime.today().date()
+    mid = stops_per_trip // 2
+    corridor = [f"S{i}" for i in range(stops_per_trip)]
+    services = [f"SVC{i}" for i in range(n_services)]
+    trips = {}
+    lines = {name: [] for name in gtfs_columns}
+    lines["stops"].append("stop_id,stop_name")
+    lines["stops"] += [f"{x},Stop {x}" for x in corridor + platform_pair.split("-")]
+    lines["calendar"].append(",".join(gtfs_columns["calendar"]))
+    for service_id in services:
+        days = ",".join(random.choice("01") for _ in range(6)) + ",1"
+        start = (today - timedelta(days=30)).strftime("%Y%m%d")
+        end = (today + timedelta(days=335)).strftime("%Y%m%d")
+        lines["calendar"].append(f"{service_id},{days},{start},{end}")
+    lines["calendar_dates"].append("service_id,date,exception_type")
+    for _ in range(n_exceptions):
+        day = today + timedelta(days=random.randint(-30, 335))
+        lines["calendar_dates"].append(
+            f"{random.choice(services)},{day.strftime('%Y%m%d')},{random.choice('12')}"
+        )
+    lines["trips"].append("route_id,service_id,trip_id")
+    lines["stop_times"].append(
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence"
+    )
+    for i in range(n_trips):
+        trip_id = f"T{i}"
+        lines["trips"].append(f"R,{random.choice(services)},{trip_id}")
+        stops = corridor if i % 2 else corridor[::-1]
+        stops = stops[: random.randint(mid + 1, stops_per_trip)]
+        platform = platform_pair.split("-")[i % 2]
+        stops = [platform if x == corridor[mid] else x for x in stops]
+        seconds = 4 * 3600 + random.randrange(21 * 3600)
+        trips[trip_id] = []
+        for seq, stop_id in enumerate(stops):
+            time_str = gtfs_time_str(seconds)
+            lines["stop_times"].append(
+                f"{trip_id},{time_str},{time_str},{stop_id},{seq}"
+            )
+            trips[trip_id].append((stop_id, seconds))
+            seconds += random.randint(90, 300)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, rows in lines.items():
+            archive.writestr(f"{name}.txt", "\n".join(rows) + "\n")
+    return trips
+
+
+def synthetic_trip_updates(trips, now):
+    # GTFS-RT FeedMessage with an entity per trip: mostly delays, some canceled,
+    # some added, timed relative to today's service day
+    random.seed(len(trips))
+    service_day = datetime.combine(now.date(), time())
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(now.timestamp())
+    for i, (trip_id, stops) in enumerate(trips.items()):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = trip_id
+        trip_update.timestamp = feed.header.timestamp
+        roll = random.random()
+        if roll < 0.05:
+            trip_update.trip.schedule_relationship = 3  # canceled
+        elif roll < 0.1:
+            trip_update.trip.schedule_relationship = 1  # added
+            trip_update.trip.trip_id = f"A{i}"
+        delay = random.randint(-60, 900)
+        for stop_id, seconds in stops:
+            stu = trip_update.stop_time_update.add()
+            stu.stop_id = stop_id
+            stu.arrival.time = int(service_day.timestamp()) + seconds + delay
+    return RecordedResponse(feed.SerializeToString())
+
+
+def synthetic_wmata_predictions(n_trains, location_code="E09"):
+    # GetPrediction json, including the placeholder entries the board filters out
+    random.seed(n_trains)
+    trains = []
+    for i in range(n_trains):
+        trains.append(
+            {
+                "Car": "8",
+                "Destination": "Dest",
+                "DestinationCode": "E10",
+                "DestinationName": random.choice(
+                    ["Greenbelt", "Branch Av", "Huntington", "No Passenger", "Train"]
+                ),
+                "Group": str(i % 2 + 1),
+                "Line": random.choice(["GR", "YL", "--"]),
+                "LocationCode": location_code,
+                "LocationName": "College Park-U of Md",
+                "Min": random.choice(
+                    ["ARR", "BRD", "DLY", "", str(random.randint(1, 30))]
+                ),
+            }
+        )
+    return RecordedResponse(json.dumps({"Trains": trains}).encode())
+
+
+def measure(fn, repeat):
+    # best wall time over repeat runs, then one run under tracemalloc for
+    # peak memory and the number of blocks still allocated afterwards
+    wall = min(timeit.repeat(fn, number=1, repeat=repeat))
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = sys.getallocatedblocks() - blocks
+    del result
+    return {
+        "wall_ms": wall * 1000,
+        "peak_kib": peak / 1024,
+        "retained_blocks": retained,
+    }
+
+
+def run_benchmarks(args, workdir):
+    feed_path = Path(workdir) / "feed.zip"
+    cache_path = Path(workdir) / "feed.cache"
+    trips = write_synthetic_gtfs(
+        feed_path, args.trips, args.stops, args.services, args.exceptions
+    )
+    now = datetime.today()
+    realtime = synthetic_trip_updates(trips, now)
+    metro = synthetic_wmata_predictions(args.trains)
+    gtfs_info = read_gtfs_files(feed_path, platform_pair)
+    gtfs_sched = get_gtfs_schedule(gtfs_info, platform_pair)
+    rows = ["<div></div>"] * 6
+    board_path = Path(workdir) / "DepartureBoard.html"
+
+    def startup_cold():
+        cache_path.unlink(missing_ok=True)
+        return load_gtfs_schedule(feed_path, platform_pair, cache_path)
+
+    def merge():
+        parsed_realtime["digest"] = None  # parse every run
+        sched = get_departures_in_window(
+            gtfs_info, gtfs_sched, now - realtime_lookback, now + timedelta(minutes=99)
+        )
+        return merge_realtime_updates(
+            sched, parse_realtime_updates(realtime.content, platform_pair.split("-"))
+        )
+
+    def write():
+        arrivals.written_pages.clear()  # skip-if-unchanged would make this a no-op
+        write_rows(rows, board_path)
+
+    stages = {
+        "startup_cold": startup_cold,
+        "startup_warm": lambda: load_gtfs_schedule(
+            feed_path, platform_pair, cache_path
+        ),
+        "read_gtfs_files": lambda: read_gtfs_files(feed_path, platform_pair),
+        "read_gtfs_files_parallel": lambda: read_gtfs_files(
+            feed_path, platform_pair, args.workers
+        ),
+        "get_gtfs_schedule": lambda: get_gtfs_schedule(gtfs_info, platform_pair),
+        "build_day_view": lambda: build_day_view(gtfs_info, gtfs_sched, now.date()),
+        "get_departures_in_window": lambda: get_departures_in_window(
+            gtfs_info, gtfs_sched, now - realtime_lookback, now + timedelta(minutes=99)
+        ),
+        "build_next_index": lambda: build_next_index(gtfs_info, gtfs_sched, now.date()),
+        "get_next_scheduled": lambda: get_next_scheduled(gtfs_info, gtfs_sched, now),
+        "merge": merge,
+        "combine_realtime_with_sched": lambda: combine_realtime_with_sched(
+            realtime, platform_pair, gtfs_info, gtfs_sched
+        ),
+        "get_metro_rows": lambda: get_metro_rows(get_metro_departures(metro.json())),
+        "write_rows": write,
+    }
+    results = {}
+    for name, fn in stages.items():
+        if args.stage and name not in args.stage:
+            continue
+        if name == "startup_warm":
+            startup_cold()  # make sure the cache exists
+        if name == "read_gtfs_files_parallel":
+            # must match the sequential parse, also with blocks small enough
+            # that trips are split across them
+            chunk_bytes = gtfs_helpers.stop_times_chunk_bytes
+            for size in (chunk_bytes, 64 << 10):
+                gtfs_helpers.stop_times_chunk_bytes = size
+                if fn() != gtfs_info:
+                    sys.exit(f"{name} differs from read_gtfs_files")
+            gtfs_helpers.stop_times_chunk_bytes = chunk_bytes
+        results[name] = measure(fn, args.repeat)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def previous_run(params):
+    # last saved run with the same feed size
+    if not results_path.exists():
+        return None
+    previous = None
+    with open(results_path, "r") as infile:
+        for line in infile:
+            run = json.loads(line)
+            if run["params"] == params:
+                previous = run
+    return previous
+
+
+def report(results, previous):
+    print(f"{'stage':<30}{'wall ms':>10}{'peak KiB':>12}{'blocks':>10}{'vs last':>10}")
+    for name, x in results.items():
+        change = ""
+        if previous and name in previous["results"]:
+            last = previous["results"][name]["wall_ms"]
+            change = f"{(x['wall_ms'] - last) / last * 100:+.0f}%" if last else ""
+        print(
+            f"{name:<30}{x['wall_ms']:>10.2f}{x['peak_kib']:>12.0f}{x['retained_blocks']:>10}{change:>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trips", type=int, default=2000, help="Trips in the feed")
+    parser.add_argument("--stops", type=int, default=20, help="Stops per trip")
+    parser.add_argument("--services", type=int, default=10, help="Service ids")
+    parser.add_argument(
+        "--exceptions", type=int, default=200, help="calendar_dates exceptions"
+    )
+    parser.add_argument(
+        "--trains", type=int, default=40, help="Trains in the WMATA predictions"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes for read_gtfs_files_parallel",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per stage, best is reported"
+    )
+    parser.add_argument(
+        "--stage", action="append", help="Only run this stage, can be repeated"
+    )
+    parser.add_argument(
+        "--no-save", action="store_true", help="Don't append to bench_results.jsonl"
+    )
+    args = parser.parse_args()
+    params = {
+        "trips": args.trips,
+        "stops": args.stops,
+        "services": args.services,
+        "exceptions": args.exceptions,
+        "trains": args.trains,
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(args, workdir)
+    report(results, previous_run(params))
+    if not args.no_save:
+        with open(results_path, "a") as outfile:
+            run = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "params": params,
+                "results": results,
+            }
+            outfile.write(json.dumps(run) + "\n")
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from threading import Condition, Thread
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+import json
+import posixpath
+import re
+
+"""
+Local HTTP server for the board, used with arrivals.py --serve PORT.
+The page is served once and rows are pushed to it over Server-Sent Events,
+only the rows that changed since the browser's last update are sent.
+
+/                 board page
+/events           Server-Sent Events, data is {"rows": {row index: html}}
+/departures.json  merged departures behind the current rows
+/metrics          refresh stage timings and counters in the Prometheus text format
+/images/...       static files the page needs, nothing else in the repo folder is served
+"""
+
+static_files = {"/DepartureBoard.css"}
+
+# replaces the template's meta refresh, the page stays open and gets pushed updates
+event_script = """<script>
+const source = new EventSource("/events");
+source.onmessage = (event) => {
+    const rows = JSON.parse(event.data).rows;
+    for (const [i, html] of Object.entries(rows)) {
+        document.getElementById(`row-${i}`).innerHTML = html;
+    }
+};
+</script>
+"""
+
+
+def compile_template_text(text):
+    # Splits a template on its "Row N" placeholders once, so rendering is a join.
+    # Returns [text, row index, text, row index, ..., text]
+    parts = re.split(r"Row (\d+)", text)
+    return [int(x) if i % 2 else x for i, x in enumerate(parts)]
+
+
+def compile_template(path):
+    with open(path, "r") as infile:
+        return compile_template_text(infile.read())
+
+
+def render_template(parts, rows):
+    return "".join(
+        (rows[x] if x < len(rows) else f"Row {x}") if i % 2 else x
+        for i, x in enumerate(parts)
+    )
+
+
+class BoardState:
+    # latest rows and departures, shared between the render loop and the server threads
+    def __init__(self):
+        self.changed = Condition()
+        self.version = 0
+        self.rows = []
+        self.departures = {}
+
+    def publish(self, rows, departures):
+        with self.changed:
+            if rows == self.rows and departures == self.departures:
+                return
+            self.rows = list(rows)
+            self.departures = departures
+            self.version += 1
+            self.changed.notify_all()
+
+    def snapshot(self):
+        with self.changed:
+            return self.rows, self.departures
+
+    def wait(self, version, timeout):
+        # returns (version, rows) once newer than version, or the current ones on timeout
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version, self.rows
+
+
+def make_handler(state, page_parts, directory, metrics_text):
+    class BoardHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, format, *args):
+            pass  # keep the kiosk log quiet
+
+        def send_body(self, body, content_type):
+            body = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def static_path(self):
+            # Normalized request path if it names a file the page may load, else None.
+            # Checked after resolving ".." and escapes, so /images/../ can't reach
+            # the key files next to the template.
+            path = posixpath.normpath(unquote(urlsplit(self.path).path))
+            if path in static_files:
+                return path
+            images = (Path(directory) / "images").resolve()
+            file = (Path(directory) / path.lstrip("/")).resolve()
+            if file.is_relative_to(images) and file.is_file():
+                return path
+            return None
+
+        def do_GET(self):
+            if self.path == "/":
+                rows, _ = state.snapshot()
+                # rows that haven't been rendered yet are left blank until pushed
+                rows = rows + [""] * (len(page_parts) // 2 - len(rows))
+                self.send_body(
+                    render_template(page_parts, rows), "text/html; charset=utf-8"
+                )
+            elif self.path == "/departures.json":
+                _, departures = state.snapshot()
+                self.send_body(json.dumps(departures), "application/json")
+            elif self.path == "/metrics" and metrics_text:
+                self.send_body(metrics_text(), "text/plain; version=0.0.4")
+            elif self.path == "/events":
+                self.stream_events()
+            elif self.static_path() is not None:
+                self.path = self.static_path()
+                super().do_GET()
+            else:
+                self.send_error(404)
+
+        def stream_events(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            version = None
+            sent = []
+            try:
+                while True:
+                    new_version, rows = state.wait(version, timeout=15)
+                    if new_version == version:
+                        self.wfile.write(b": keepalive\n\n")
+                    else:
+                        changed = {
+                            i: row
+                            for i, row in enumerate(rows)
+                            if i >= len(sent) or sent[i] != row
+                        }
+                        if changed:
+                            data = json.dumps({"rows": changed})
+                            self.wfile.write(f"data: {data}\n\n".encode())
+                        version = new_version
+                        sent = rows
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # browser went away
+
+    return BoardHandler
+
+
+def start_board_server(port, state, metrics_text=None, template_path="template.html"):
+    directory = str(Path(template_path).absolute().parent)
+    page = render_template(compile_template(template_path), [])
+    page = re.sub(r"\s*<meta http-equiv=\"Refresh\"[^>]*>", "", page)
+    page = page.replace("</body>", f"{event_script}</body>")
+    page_parts = compile_template_text(page)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), make_handler(state, page_parts, directory, metrics_text)
+    )
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+
+"""
+Append-only log of the raw realtime responses the board fetched, so feed anomalies
+can be replayed offline. Used with arrivals.py --capture LOG and --replay LOG.
+
+Each refresh cycle is appended as its own gzip member, gzip reads them back to back.
+If the log ends in a partial write (the board was killed mid-append), the last
+cycle is dropped on read.
+A record is a json header line followed by the n bytes of the raw response body:
+{"time": fetch unix time, "provider": "marc", "status": 200, "length": n}
+A provider with no response (network error or missed deadline) has status null.
+"""
+
+
+class RecordedResponse:
+    # stands in for a requests.Response of a recorded or generated payload
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.headers = {}
+        self.status_code = status_code
+
+    def __bool__(self):
+        # like requests.Response, falsy for error statuses
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def append_cycle(path, fetch_time, responses):
+    # responses is {provider: response or None} from one refresh
+    with gzip.open(path, "ab") as outfile:
+        for provider, resp in responses.items():
+            body = resp.content if resp is not None else b""
+            header = {
+                "time": fetch_time,
+                "provider": provider,
+                "status": resp.status_code if resp is not None else None,
+                "length": len(body),
+            }
+            outfile.write(json.dumps(header).encode() + b"\n")
+            outfile.write(body)
+
+
+def read_cycles(path):
+    # Yields (fetch unix time, {provider: RecordedResponse or None}) in capture order
+    fetch_time = None
+    responses = {}
+    with gzip.open(path, "rb") as infile:
+        try:
+            while True:
+                line = infile.readline()
+                if not line:
+                    break
+                header = json.loads(line)
+                body = infile.read(header["length"])
+                if len(body) < header["length"]:
+                    break
+                if header["time"] != fetch_time:
+                    if responses:
+                        yield fetch_time, responses
+                    fetch_time = header["time"]
+                    responses = {}
+                responses[header["provider"]] = (
+                    RecordedResponse(body, header["status"])
+                    if header["status"] is not None
+                    else None
+                )
+        except (EOFError, gzip.BadGzipFile, ValueError):
+            # partial write at the end, the pending cycle may be incomplete
+            return
+    if responses:
+        yield fetch_time, responses
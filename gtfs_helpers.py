@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 from google.transit import gtfs_realtime_pb2
 from pathlib import Path
-from datetime import datetime, time, timedelta
+from array import array
+from datetime import date, datetime, time, timedelta
+from contextlib import contextmanager
+from concurrent import futures
 import csv
+import io
+import zipfile
 import bisect
+import hashlib
+import multiprocessing
+import os
+import pickle
+from sys import intern
+from metrics import timed
 
 schedule_relationship = [
     "scheduled",
@@ -16,192 +27,838 @@ schedule_relationship = [
     "deleted",
 ]
 
+# how far before now scheduled trips are kept for matching late realtime updates
+realtime_lookback = timedelta(hours=2)
+# and how far past the board's 99 minutes, for early trains running inside it
+realtime_lookahead = timedelta(minutes=15)
+
+# counters for realtime feed parsing, parse_skips counts reuses of a parsed payload
+# and entity_reuses counts trip_updates taken from the previous feed's results
+realtime_stats = {"parses": 0, "parse_skips": 0, "entity_reuses": 0}
+# last parsed realtime payload, shared by every station using the feed,
+# with its realtime updates per platforms tuple
+parsed_realtime = {"digest": None, "feed": None, "updates": {}}
+# platforms tuple: {(entity id, trip_update timestamp): realtime update}
+realtime_entities = {}
+# id(gtfs_sched): (gtfs_sched, trip_ids in it), see relevant_trip_ids
+realtime_trip_ids = {}
+# trip relations whose updates only matter for trips in the static schedule
+scheduled_relationships = {
+    schedule_relationship.index(x) for x in ("scheduled", "canceled", "deleted")
+}
+
+# replaying a capture sets "now" to the time its feeds were fetched
+virtual_clock = {"now": None}
+
+# how many service days get_next_scheduled looks ahead
+next_index_days = 7
+# id(gtfs_sched): index of its upcoming departures, see build_next_index
+next_indexes = {}
+# bytes of stop_times.txt per task with read_gtfs_files workers
+stop_times_chunk_bytes = 4 << 20
+# id(gtfs_sched): departures of the service days around today, see build_day_view
+day_views = {}
+
+# bump whenever the layout of the compiled schedule cache changes
+sched_cache_version = 7
+
+# files and columns the board reads, everything else in the feed is skipped
+gtfs_columns = {
+    "stops": ("stop_id", "stop_name", "stop_code", "parent_station", "location_type"),
+    "routes": ("route_id", "route_short_name", "route_long_name"),
+    "trips": ("trip_id", "service_id", "route_id", "trip_headsign"),
+    "calendar": (
+        "service_id",
+        "monday",
+        "tuesday",
+        "wednesday",
+        "thursday",
+        "friday",
+        "saturday",
+        "sunday",
+        "start_date",
+        "end_date",
+    ),
+    "calendar_dates": ("service_id", "date", "exception_type"),
+    "stop_times": ("trip_id", "arrival_time", "stop_id", "stop_sequence"),
+}
+
+
+class Departure:
+    __slots__ = ("arrival_time", "trip_id", "service_id", "realtime")
+
+    def __init__(self, arrival_time, trip_id, service_id, realtime):
+        self.arrival_time = arrival_time
+        self.trip_id = trip_id
+        self.service_id = service_id
+        self.realtime = realtime
+
+
+class Timetable:
+    # Departures to one destination, sorted by seconds since the start of the
+    # service day (may be past 24 hours), with parallel trip and service id columns
+    __slots__ = ("times", "trip_ids", "service_ids")
+
+    def __init__(self, entries=()):
+        # entries are (seconds, trip_id, service_id)
+        entries = sorted(entries, key=(lambda x: x[0]))
+        self.times = array("l", [x[0] for x in entries])
+        self.trip_ids = [intern(x[1]) for x in entries]
+        self.service_ids = [intern(x[2]) for x in entries]
+
+    def __len__(self):
+        return len(self.times)
+
+    def window(self, start_sec, end_sec):
+        # indices of departures with start_sec <= time <= end_sec
+        return range(
+            bisect.bisect_left(self.times, start_sec),
+            bisect.bisect_right(self.times, end_sec),
+        )
+
+
+def forget_schedules():
+    # drops everything cached against the current schedules, after a reload
+    next_indexes.clear()
+    day_views.clear()
+    realtime_trip_ids.clear()
+    realtime_entities.clear()
+    parsed_realtime["updates"] = {}
+
+
+def current_time():
+    # datetime.today(), or the replay's virtual time
+    return virtual_clock["now"] or datetime.today()
+
+
+def gtfs_time_seconds(time_str):
+    # "HH:MM:SS" to seconds, cannot use builtins since GTFS may have times > 24 hours
+    hours, minutes, seconds = time_str.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def find_zip_member(archive, name):
+    # some feeds nest their files in a folder inside the zip
+    for info in archive.infolist():
+        if Path(info.filename).name == f"{name}.txt":
+            return info
+    return None
+
+
+@contextmanager
+def open_gtfs_member(source, name, binary=False):
+    # Text stream of name.txt from a feed folder, or read straight out of the
+    # feed zip without extracting it. None if the feed doesn't have that file.
+    # With binary, a byte stream instead.
+    path = Path(source)
+    if path.is_dir():
+        file = path / f"{name}.txt"
+        if not file.exists():
+            yield None
+            return
+        if binary:
+            with open(file, "rb") as infile:
+                yield infile
+            return
+        with open(file, newline="", encoding="utf-8-sig") as infile:
+            yield infile
+    else:
+        with zipfile.ZipFile(path) as archive:
+            member = find_zip_member(archive, name)
+            if member is None:
+                yield None
+                return
+            with archive.open(member) as raw:
+                if binary:
+                    yield raw
+                    return
+                yield io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+
+def select_gtfs_columns(reader, header, name):
+    # Yields a tuple of the gtfs_columns[name] values for each row from a csv reader,
+    # with "" for optional columns the feed doesn't have
+    indices = [
+        header.index(col) if col in header else None for col in gtfs_columns[name]
+    ]
+    for row in reader:
+        if row:
+            yield tuple(
+                row[i] if i is not None and i < len(row) else "" for i in indices
+            )
+
+
+def iter_gtfs_rows(source, name):
+    # select_gtfs_columns for each row of name.txt
+    with open_gtfs_member(source, name) as infile:
+        if infile is None:
+            return
+        reader = csv.reader(infile)
+        header = next(reader, [])
+        yield from select_gtfs_columns(reader, header, name)
+
+
+def reduce_stop_times(rows, platforms):
+    # Reduces stop_times rows to ({trip_id: (stop_sequence, last stop_id)} for every
+    # trip, {trip_id: {stop_id: (stop_sequence, arrival_time)}} at our platforms),
+    # keeping the first row seen on ties and skipping rows cut short
+    last_stops = {}
+    platform_stops = {}
+    for trip_id, arrival_time, stop_id, stop_sequence in rows:
+        if not stop_sequence:
+            continue  # truncated row
+        seq = int(stop_sequence)
+        last = last_stops.get(trip_id)
+        if last is None or seq > last[0]:
+            last_stops[trip_id] = (seq, intern(stop_id))
+        if stop_id in platforms:
+            trip_platforms = platform_stops.setdefault(trip_id, {})
+            first = trip_platforms.get(stop_id)
+            if first is None or seq < first[0]:
+                trip_platforms[intern(stop_id)] = (seq, arrival_time)
+    return last_stops, platform_stops
+
+
+def stop_times_trip_id(line, trip_index):
+    # trip_id of one raw stop_times.txt line, None for blank or short rows
+    row = next(csv.reader([line.decode("utf-8")]), [])
+    return row[trip_index] if len(row) > trip_index else None
+
+
+def iter_stop_times_chunks(raw, trip_index, chunk_bytes):
+    # Yields blocks of about chunk_bytes of whole stop_times.txt rows from a byte
+    # stream, cut where the trip_id changes so feeds ordered by trip have each trip
+    # in one block. The stream is only read forward, once.
+    carry = b""
+    while True:
+        block = raw.read(chunk_bytes)
+        if not block:
+            break
+        block = carry + block + raw.readline()
+        carry = b""
+        # extend to the end of the last trip in the block, skipping blank lines
+        trip_id = None
+        end = len(block)
+        while trip_id is None and end > 0:
+            start = block.rfind(b"\n", 0, end - 1) + 1
+            trip_id = stop_times_trip_id(block[start:end], trip_index)
+            end = start
+        while True:
+            line = raw.readline()
+            if not line:
+                break
+            line_trip_id = stop_times_trip_id(line, trip_index)
+            if line_trip_id is not None and line_trip_id != trip_id:
+                carry = line
+                break
+            block += line
+        yield block
+    if carry:
+        yield carry
+
+
+def read_stop_times_chunk(block, header, platforms):
+    # reduce_stop_times over one iter_stop_times_chunks block, run in a worker process
+    rows = select_gtfs_columns(
+        csv.reader(io.StringIO(block.decode("utf-8"), newline="")), header, "stop_times"
+    )
+    return reduce_stop_times(rows, platforms)
+
+
+def read_stop_times_parallel(source, platforms, workers):
+    # reduce_stop_times across a process pool, one iter_stop_times_chunks block per
+    # task with at most two per worker waiting. Results are merged in file order
+    # with the same rules, so the output is the same as the sequential pass whatever
+    # order the feed's rows are in.
+    last_stops = {}
+    platform_stops = {}
+
+    def merge(result):
+        chunk_last_stops, chunk_platform_stops = result
+        for trip_id, (seq, stop_id) in chunk_last_stops.items():
+            last = last_stops.get(trip_id)
+            if last is None or seq > last[0]:
+                last_stops[trip_id] = (seq, intern(stop_id))
+        for trip_id, chunk_platforms in chunk_platform_stops.items():
+            trip_platforms = platform_stops.setdefault(trip_id, {})
+            for stop_id, (seq, arrival_time) in chunk_platforms.items():
+                first = trip_platforms.get(stop_id)
+                if first is None or seq < first[0]:
+                    trip_platforms[intern(stop_id)] = (seq, arrival_time)
+
+    with open_gtfs_member(source, "stop_times", binary=True) as raw:
+        if raw is None:
+            return last_stops, platform_stops
+        header = next(csv.reader([raw.readline().decode("utf-8-sig")]), [])
+        trip_index = header.index("trip_id")
+        # not forked, load_static runs this from the reload thread of a threaded process
+        with futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            pending = []
+            for block in iter_stop_times_chunks(
+                raw, trip_index, stop_times_chunk_bytes
+            ):
+                pending.append(
+                    pool.submit(read_stop_times_chunk, block, header, platforms)
+                )
+                if len(pending) > 2 * workers:
+                    merge(pending.pop(0).result())
+            for task in pending:
+                merge(task.result())
+    return last_stops, platform_stops
+
+
+def station_platforms(gtfs_info, stop_ids):
+    # Platform stop_ids for a station code. A "-" separated list is taken as is
+    # (also works for a single center platform), otherwise a parent station given by
+    # stop_id, stop_code or WMATA's STN_ prefix resolves to its platforms, and a ","
+    # separated list of those (WMATA transfer stations like A01,C01) to all of theirs.
+    platforms = gtfs_info.get("platforms", {}).get(stop_ids)
+    if platforms:
+        return platforms
+    return stop_ids.split("-")
+
+
+def resolve_platforms(stops, stop_ids):
+    if "-" in stop_ids:
+        return stop_ids.split("-")
+    codes = stop_ids.split(",")
+    parents = {
+        stop_id
+        for stop_id, x in stops.items()
+        for code in codes
+        if stop_id in (code, f"STN_{code}") or x["stop_code"] == code
+    }
+    # stops with location_type 0 or blank are platforms, skip entrances and nodes
+    platforms = [
+        stop_id
+        for stop_id, x in stops.items()
+        if x["parent_station"] in parents and x["location_type"] in ("", "0")
+    ]
+    return platforms or codes
 
-def read_gtfs_files(folder_path):
-    gtfs_info = {}
-    for file in Path(folder_path).iterdir():
-        gtfs_info[file.stem] = {}
-        # key is unique in these files
-        if file.stem in {"routes", "stops", "trips"}:
-            with open(file) as infile:
-                reader = csv.DictReader(infile)
-                for row in reader:
-                    # for 'routes', use 'route_id' as the key, etc
-                    key = row[file.stem[:-1] + "_id"]
-                    gtfs_info[file.stem][key] = row
-        # service_id is unique in this file, get list of days of week it's active
-        elif file.stem == "calendar":
-            with open(file) as infile:
-                reader = csv.reader(infile)
-                for row in reader:
-                    service_id = row[0]
-                    gtfs_info[file.stem][service_id] = row[1:8]
-        # key is repeated in these files
-        elif file.stem in {"calendar_dates", "stop_times"}:
-            with open(file) as infile:
-                reader = csv.DictReader(infile)
-                for row in reader:
-                    key = (
-                        row["trip_id"]
-                        if file.stem == "stop_times"
-                        else row["service_id"]
-                    )
-                    if key in gtfs_info[file.stem]:
-                        gtfs_info[file.stem][key].append(row)
-                    else:
-                        gtfs_info[file.stem][key] = [row]
-    return gtfs_info
 
+def read_gtfs_files(source, stop_ids, workers=1):
+    # Streams only the files and columns in gtfs_columns.
+    # stop_times is reduced while parsing to the trips that call at one of the
+    # stop_ids platforms, keeping the platform arrival times and the trip's last stop,
+    # so memory doesn't grow with trips * stops per trip.
+    # Only trips calling at those platforms are kept from trips.txt.
+    # stop_ids is one station code or a list of them, all read in a single pass.
+    # With workers > 1, stop_times is split across that many processes.
+    station_codes = [stop_ids] if isinstance(stop_ids, str) else stop_ids
+    gtfs_info = {
+        "stops": {},
+        "routes": {},
+        "trips": {},
+        "calendar": {},
+        "calendar_dates": {},
+        "stop_times": {},
+        "platforms": {},
+    }
+    for stop_id, stop_name, stop_code, parent_station, location_type in iter_gtfs_rows(
+        source, "stops"
+    ):
+        gtfs_info["stops"][stop_id] = {
+            "stop_name": stop_name,
+            "stop_code": stop_code,
+            "parent_station": parent_station,
+            "location_type": location_type,
+        }
+    for code in station_codes:
+        gtfs_info["platforms"][code] = resolve_platforms(gtfs_info["stops"], code)
+    platforms = {x for code in station_codes for x in gtfs_info["platforms"][code]}
 
-def get_gtfs_schedule(gtfs_info, stop_ids):
-    platform_pair = stop_ids.split("-")  # also works for a single center platform
-    gtfs_sched = {}
-    for trip_id, info_list in gtfs_info["stop_times"].items():
-        service_id = gtfs_info["trips"][trip_id]["service_id"]
-        for info in info_list:
-            if info["stop_id"] in platform_pair:
-                last_stop = info_list[-1]["stop_id"]
-                if last_stop not in platform_pair and last_stop in gtfs_sched:
-                    bisect.insort_right(
-                        gtfs_sched[last_stop],
-                        {
-                            "arrival_time": info["arrival_time"],
-                            "trip_id": trip_id,
-                            "service_id": service_id,
-                            "realtime": False,
-                        },
-                        key=(lambda x: x["arrival_time"]),
-                    )
-                elif last_stop not in platform_pair:
-                    gtfs_sched[last_stop] = [
-                        {
-                            "arrival_time": info["arrival_time"],
-                            "trip_id": trip_id,
-                            "service_id": service_id,
-                            "realtime": False,
-                        }
-                    ]
-                break  # to next trip_id
-    return gtfs_sched
-
-
-def service_is_running(gtfs_info, service_id, dt: datetime.date):
-    str_dt = dt.strftime("%Y%m%d")
-    for entry in gtfs_info["calendar_dates"].get(service_id, []):
-        # if found in calendar_dates, overrides other info
-        if entry["date"] == str_dt:
-            return entry["exception_type"] == "1"
-    # if date wasn't in this service_id's calendar dates, check regular calendar list
+    if workers > 1:
+        last_stops, platform_stops = read_stop_times_parallel(
+            source, platforms, workers
+        )
     else:
-        if service_id in gtfs_info.get("calendar", {}):
-            return gtfs_info["calendar"][service_id][dt.weekday()] == "1"
+        last_stops, platform_stops = reduce_stop_times(
+            iter_gtfs_rows(source, "stop_times"), platforms
+        )
+    for trip_id, trip_platforms in platform_stops.items():
+        gtfs_info["stop_times"][trip_id] = {
+            "platforms": trip_platforms,
+            "last_stop": last_stops[trip_id][1],
+        }
+    del last_stops
+
+    for route_id, short_name, long_name in iter_gtfs_rows(source, "routes"):
+        gtfs_info["routes"][route_id] = short_name or long_name
+    # every service_id trips refer to, to find services missing from the calendar
+    trip_services = set()
+    for trip_id, service_id, route_id, headsign in iter_gtfs_rows(source, "trips"):
+        trip_services.add(service_id)
+        if trip_id in platform_stops:
+            gtfs_info["trips"][trip_id] = {
+                "service_id": intern(service_id),
+                "route_id": intern(route_id),
+                "trip_headsign": intern(headsign),
+            }
+    # service_id is unique in this file, get list of days of week it's active
+    # followed by its start and end dates
+    for service_id, *days in iter_gtfs_rows(source, "calendar"):
+        gtfs_info["calendar"][service_id] = days
+    # service_id is repeated in this file
+    for service_id, date_str, exception_type in iter_gtfs_rows(
+        source, "calendar_dates"
+    ):
+        gtfs_info["calendar_dates"].setdefault(service_id, []).append(
+            {"date": date_str, "exception_type": exception_type}
+        )
+    gtfs_info["services"] = build_service_index(gtfs_info, trip_services)
+    return gtfs_info
+
+
+def get_gtfs_schedule(gtfs_info, stop_ids, group_by="last_stop"):
+    # {destination: Timetable} of trips calling at the stop_ids platforms.
+    # Destinations are the trip's last stop_id, or with group_by="headsign" a
+    # (trip_headsign, route) tuple, for feeds like WMATA's where many platforms
+    # end a line and the headsign is what riders see.
+    platform_pair = station_platforms(gtfs_info, stop_ids)
+    entries = {}
+    for trip_id, info in gtfs_info["stop_times"].items():
+        last_stop = info["last_stop"]
+        if last_stop in platform_pair:
+            continue  # trip ends here
+        # first of our platforms the trip calls at
+        calls = [
+            x for stop_id, x in info["platforms"].items() if stop_id in platform_pair
+        ]
+        if not calls:
+            continue  # trip is for another station
+        arrival_time = min(calls)[1]
+        if not arrival_time:
+            continue  # isn't timed at our platform
+        trip = gtfs_info["trips"][trip_id]
+        if group_by == "headsign":
+            dest = (
+                trip["trip_headsign"],
+                gtfs_info["routes"].get(trip["route_id"], ""),
+            )
         else:
-            return True
+            dest = last_stop
+        entries.setdefault(dest, []).append(
+            (gtfs_time_seconds(arrival_time), trip_id, trip["service_id"])
+        )
+    return {dest: Timetable(x) for dest, x in entries.items()}
+
+
+def gtfs_feed_version(source):
+    # newest modification time and a content hash over the feed files the board reads
+    mtime = 0
+    digest = hashlib.sha1()
+    if not Path(source).is_dir():
+        # the zip's central directory already has a CRC of every member
+        mtime = Path(source).stat().st_mtime_ns
+        with zipfile.ZipFile(source) as archive:
+            for name in gtfs_columns:
+                member = find_zip_member(archive, name)
+                if member is not None:
+                    digest.update(f"{name}:{member.CRC}:{member.file_size}".encode())
+        return mtime, digest.hexdigest()
+    for name in gtfs_columns:
+        file = Path(source) / f"{name}.txt"
+        if not file.exists():
+            continue
+        mtime = max(mtime, file.stat().st_mtime_ns)
+        digest.update(file.name.encode())
+        with open(file, "rb") as infile:
+            while chunk := infile.read(1 << 20):
+                digest.update(chunk)
+    return mtime, digest.hexdigest()
+
+
+def load_gtfs_schedules(
+    source, station_codes, cache_path=None, group_by="last_stop", workers=1
+):
+    # Returns (gtfs_info, {stop_ids: gtfs_sched}) for every station code, from one
+    # pass over the feed, reusing a compiled cache next to the feed so restarts skip
+    # the CSV parse when nothing changed.
+    # The cached gtfs_info only keeps what the board needs after startup:
+    # stop names and the service day index.
+    station_codes = list(station_codes)
+    if cache_path is None:
+        cache_path = Path(f"{Path(source)}.{'+'.join(station_codes)}.cache")
+    key = (sched_cache_version, station_codes, group_by, *gtfs_feed_version(source))
+    try:
+        with open(cache_path, "rb") as infile:
+            # key is pickled separately so a stale cache is rejected before loading the rest
+            if pickle.load(infile) == key:
+                return pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        pass  # missing or unreadable cache, rebuild it
+
+    gtfs_info = read_gtfs_files(source, station_codes, workers)
+    gtfs_scheds = {
+        code: get_gtfs_schedule(gtfs_info, code, group_by) for code in station_codes
+    }
+    compiled_info = {
+        "stops": {
+            stop_id: {"stop_name": x["stop_name"]}
+            for stop_id, x in gtfs_info["stops"].items()
+        },
+        "services": gtfs_info["services"],
+        "platforms": gtfs_info["platforms"],
+    }
+    # write to a temp file and rename so a killed process never leaves a torn cache
+    temp_path = Path(f"{cache_path}.tmp")
+    try:
+        with open(temp_path, "wb") as outfile:
+            pickle.dump(key, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(
+                (compiled_info, gtfs_scheds), outfile, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temp_path, cache_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+    return compiled_info, gtfs_scheds
+
+
+def load_gtfs_schedule(source, stop_ids, cache_path=None):
+    # load_gtfs_schedules for a single station, returns (gtfs_info, gtfs_sched)
+    gtfs_info, gtfs_scheds = load_gtfs_schedules(source, [stop_ids], cache_path)
+    return gtfs_info, gtfs_scheds[stop_ids]
+
+
+def gtfs_date_ordinal(date_str):
+    # "YYYYMMDD" to a proleptic Gregorian ordinal, None if blank
+    if not date_str:
+        return None
+    return date(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8])).toordinal()
+
+
+def build_service_index(gtfs_info, trip_services=()):
+    # Bitset per service_id over the feed's validity range,
+    # bit i is set if the service runs on the range's first day + i days.
+    # Built once per feed load so schedule filtering is one set lookup per trip.
+    calendar = gtfs_info["calendar"]
+    calendar_dates = gtfs_info["calendar_dates"]
+    ordinals = [
+        gtfs_date_ordinal(x) for days in calendar.values() for x in days[7:9] if x
+    ]
+    ordinals += [
+        gtfs_date_ordinal(x["date"])
+        for entries in calendar_dates.values()
+        for x in entries
+    ]
+    start = min(ordinals, default=0)
+    end = max(ordinals, default=-1)
+    bits = {}
+    for service_id, days in calendar.items():
+        first = gtfs_date_ordinal(days[7]) or start
+        last = gtfs_date_ordinal(days[8]) or end
+        service_bits = 0
+        for ordinal in range(first, last + 1):
+            # date.fromordinal(1) is a Monday
+            if days[(ordinal - 1) % 7] == "1":
+                service_bits |= 1 << (ordinal - start)
+        bits[service_id] = service_bits
+    # calendar_dates overrides the regular calendar
+    for service_id, entries in calendar_dates.items():
+        service_bits = bits.get(service_id, 0)
+        for entry in entries:
+            bit = 1 << (gtfs_date_ordinal(entry["date"]) - start)
+            if entry["exception_type"] == "1":
+                service_bits |= bit
+            else:
+                service_bits &= ~bit
+        bits[service_id] = service_bits
+    # trips with a service_id in neither file are treated as always running
+    always = frozenset(x for x in trip_services if x not in bits)
+    return {"start": start, "end": end, "bits": bits, "always": always, "active": {}}
+
+
+def active_services(gtfs_info, dt: date):
+    # set of service_ids running on the service day dt
+    index = gtfs_info["services"]
+    ordinal = dt.toordinal()
+    active = index["active"].get(ordinal)
+    if active is None:
+        active = set(index["always"])
+        if index["start"] <= ordinal <= index["end"]:
+            bit = ordinal - index["start"]
+            active.update(
+                service_id
+                for service_id, service_bits in index["bits"].items()
+                if service_bits >> bit & 1
+            )
+        active = frozenset(active)
+        if len(index["active"]) > 16:
+            index["active"].clear()  # only a few days are ever looked at
+        index["active"][ordinal] = active
+    return active
+
+
+def build_next_index(gtfs_info, gtfs_sched, dt: date):
+    # Sorted seconds since the start of yesterday's service day of every departure
+    # in gtfs_sched on yesterday's service day, for its trips that run past
+    # midnight, and the next_index_days service days starting with dt
+    first = dt - timedelta(days=1)
+    times = []
+    for day in range(next_index_days + 1):
+        active = active_services(gtfs_info, first + timedelta(days=day))
+        offset = day * 86400
+        for timetable in gtfs_sched.values():
+            service_ids = timetable.service_ids
+            times += [
+                x + offset
+                for i, x in enumerate(timetable.times)
+                if service_ids[i] in active
+            ]
+    times.sort()
+    return {
+        "sched": gtfs_sched,
+        "ordinal": dt.toordinal(),
+        "start": datetime.combine(first, time()),
+        "times": array("l", times),
+    }
 
 
 def get_next_scheduled(gtfs_info, gtfs_sched, dt: datetime):
-    timeout = 7
-    while timeout > 0:
-        day_sched = get_sched_for_day(gtfs_info, gtfs_sched, dt.date())
-        next_for_day = None
-        for times in day_sched.values():  # iterate destinations for day
-            next_for_dest = None
-            for time in times:  # iterate times for destination
-                if time["arrival_time"] > dt:
-                    next_for_dest = time["arrival_time"]
-                    break
-            if not next_for_day or (next_for_dest and next_for_dest < next_for_day):
-                next_for_day = next_for_dest
-        if next_for_day:
-            return next_for_day
-        else:  # see if it's running tomorrow
-            dt = dt.replace(hour=0, minute=0, second=0) + timedelta(days=1)
-        timeout -= 1
-    return None
+    # First scheduled departure after dt within the next week, None if there isn't one.
+    # A bisect into an index of the coming days, rebuilt when the service day rolls
+    # over or the schedule is reloaded, so an idle board costs nothing to refresh.
+    index = next_indexes.get(id(gtfs_sched))
+    if (
+        index is None
+        or index["sched"] is not gtfs_sched
+        or index["ordinal"] != dt.date().toordinal()
+    ):
+        index = build_next_index(gtfs_info, gtfs_sched, dt.date())
+        next_indexes[id(gtfs_sched)] = index
+    times = index["times"]
+    i = bisect.bisect_right(times, (dt - index["start"]).total_seconds())
+    if i == len(times):
+        return None
+    return index["start"] + timedelta(seconds=times[i])
+
+
+def build_day_view(gtfs_info, gtfs_sched, dt: date):
+    # {last_stop: Timetable} of the departures that run on yesterday's, today's and
+    # tomorrow's service days, in seconds since the start of yesterday's, so trips
+    # past midnight and windows across midnight need no special casing
+    first = dt - timedelta(days=1)
+    actives = [
+        active_services(gtfs_info, first + timedelta(days=day)) for day in range(3)
+    ]
+    view = {}
+    for last_stop, timetable in gtfs_sched.items():
+        times = timetable.times
+        trip_ids = timetable.trip_ids
+        service_ids = timetable.service_ids
+        view[last_stop] = Timetable(
+            (x + day * 86400, trip_ids[i], service_ids[i])
+            for day, active in enumerate(actives)
+            for i, x in enumerate(times)
+            if service_ids[i] in active
+        )
+    return {
+        "sched": gtfs_sched,
+        "ordinal": dt.toordinal(),
+        "start": datetime.combine(first, time()),
+        "view": view,
+    }
 
 
-def get_sched_for_day(gtfs_info, gtfs_sched, dt: datetime.date):
+def get_day_view(gtfs_info, gtfs_sched, dt: date):
+    # build_day_view for dt, kept until the service day rolls over or the schedule
+    # is reloaded
+    view = day_views.get(id(gtfs_sched))
+    if (
+        view is None
+        or view["sched"] is not gtfs_sched
+        or view["ordinal"] != dt.toordinal()
+    ):
+        view = build_day_view(gtfs_info, gtfs_sched, dt)
+        day_views[id(gtfs_sched)] = view
+    return view
+
+
+def get_departures_in_window(gtfs_info, gtfs_sched, start, end):
+    # {last_stop: [Departure]} arriving between the start and end datetimes on
+    # whichever service day, as long as the window is within a day of start's date
+    view = get_day_view(gtfs_info, gtfs_sched, start.date())
+    view_start = view["start"]
+    start_sec = (start - view_start).total_seconds()
+    end_sec = (end - view_start).total_seconds()
     ret = {}
-    for last_stop, sched in gtfs_sched.items():
+    for last_stop, timetable in view["view"].items():
+        times = timetable.times
+        trip_ids = timetable.trip_ids
+        service_ids = timetable.service_ids
         ret[last_stop] = [
-            {
-                "arrival_time": datetime.combine(dt, time())
-                + timedelta(  # cannot use builtins for this since GTFS may have arrival time > 24 hours
-                    hours=int(x["arrival_time"].split(":")[0]),
-                    minutes=int(x["arrival_time"].split(":")[1]),
-                    seconds=int(x["arrival_time"].split(":")[2]),
-                ),
-                "trip_id": x["trip_id"],
-                "service_id": x["service_id"],
-                "realtime": x["realtime"],
-            }
-            for x in sched
-            if service_is_running(gtfs_info, x["service_id"], dt)
+            Departure(
+                view_start + timedelta(seconds=times[i]),
+                trip_ids[i],
+                service_ids[i],
+                False,
+            )
+            for i in timetable.window(start_sec, end_sec)
         ]
     return ret
 
 
+def relevant_trip_ids(gtfs_sched):
+    # set of trip_ids in gtfs_sched, built once per schedule object
+    relevant = realtime_trip_ids.get(id(gtfs_sched))
+    if relevant is None or relevant[0] is not gtfs_sched:
+        trip_ids = frozenset(
+            x for timetable in gtfs_sched.values() for x in timetable.trip_ids
+        )
+        relevant = (gtfs_sched, trip_ids)
+        realtime_trip_ids[id(gtfs_sched)] = relevant
+    return relevant[1]
+
+
+def get_realtime_update(trip_update, platform_pair):
+    # (trip_id, sched_relation, last_stop, time at our platform or None)
+    stop_updates = trip_update.stop_time_update
+    last_stop = stop_updates[-1].stop_id if len(stop_updates) >= 1 else None
+    used_time = None
+    for stu in stop_updates:
+        if stu.stop_id in platform_pair:
+            if stu.HasField("arrival"):
+                used_time = datetime.fromtimestamp(stu.arrival.time)
+                break
+            elif stu.HasField("departure"):
+                used_time = datetime.fromtimestamp(stu.departure.time)
+                break
+    return (
+        trip_update.trip.trip_id,
+        schedule_relationship[trip_update.trip.schedule_relationship],
+        last_stop,
+        used_time,
+    )
+
+
+def get_realtime_updates(feed, platform_pair, trip_ids=None, cache=None):
+    # Yields get_realtime_update for each trip_update in a parsed FeedMessage.
+    # With trip_ids, updates to other scheduled trips are skipped without looking at
+    # their stops, since the merge could only drop them. Added trips can't be known
+    # in advance and are always looked at.
+    # cache is {(entity id, timestamp): update} from the previous feed, replaced with
+    # this feed's, so entities the producer hasn't touched aren't walked again.
+    previous = dict(cache or {})
+    if cache is not None:
+        cache.clear()
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        trip_update = entity.trip_update
+        relation = trip_update.trip.schedule_relationship
+        if (
+            trip_ids is not None
+            and relation in scheduled_relationships
+            and trip_update.trip.trip_id not in trip_ids
+        ):
+            continue
+        key = (entity.id, trip_update.timestamp) if trip_update.timestamp else None
+        update = previous.get(key) if key else None
+        if update is None:
+            update = get_realtime_update(trip_update, platform_pair)
+        else:
+            realtime_stats["entity_reuses"] += 1
+        if key and cache is not None:
+            cache[key] = update
+        yield update
+
+
+def parse_realtime_feed(content):
+    # FeedMessage of a serialized payload. It's parsed once for all stations, and
+    # reused while it's identical (e.g. a 304 or an unchanged feed)
+    digest = hashlib.sha1(content).digest()
+    if parsed_realtime["digest"] == digest:
+        realtime_stats["parse_skips"] += 1
+    else:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        realtime_stats["parses"] += 1
+        parsed_realtime.update(digest=digest, feed=feed, updates={})
+    return parsed_realtime["feed"]
+
+
+def parse_realtime_updates(content, platform_pair, trip_ids=None):
+    # get_realtime_updates for a serialized FeedMessage, see parse_realtime_feed
+    with timed("parse"):
+        parse_realtime_feed(content)
+        key = tuple(platform_pair)
+        updates = parsed_realtime["updates"].get(key)
+        if updates is None:
+            updates = list(
+                get_realtime_updates(
+                    parsed_realtime["feed"],
+                    platform_pair,
+                    trip_ids,
+                    realtime_entities.setdefault(key, {}),
+                )
+            )
+            parsed_realtime["updates"][key] = updates
+    return updates
+
+
+def merge_realtime_updates(sched, updates):
+    # Applies realtime updates to sched ({last_stop: [Departure]}) in place as an
+    # overlay keyed by trip_id, so each update costs O(1) instead of a list rebuild
+    slots = {}  # trip_id: (last_stop, index in sched[last_stop])
+    for last_stop, times in sched.items():
+        for i, x in enumerate(times):
+            slots[x.trip_id] = (last_stop, i)
+    canceled = set()
+    changed = set()  # destinations that need to be cleaned up and resorted
+    for trip_id, sched_relation, last_stop, used_time in updates:
+        # scheduled trips are found by trip_id, since a cancellation needn't list any
+        # stops and a short turned trip ends somewhere else, last_stop only places
+        # trips that aren't in the schedule
+        slot = slots.get(trip_id)
+        if sched_relation in ("canceled", "deleted"):
+            # remove from schedule
+            if slot:
+                canceled.add(trip_id)
+                changed.add(slot[0])
+        elif used_time is None:
+            continue  # no time at our platform
+        elif sched_relation == "scheduled":
+            # replace scheduled time with real time
+            if slot:
+                x = sched[slot[0]][slot[1]]
+                sched[slot[0]][slot[1]] = Departure(
+                    used_time, x.trip_id, x.service_id, True
+                )
+                changed.add(slot[0])
+        elif last_stop in sched:
+            # add unscheduled time, sorted into place below
+            sched[last_stop].append(Departure(used_time, trip_id, None, True))
+            changed.add(last_stop)
+    for last_stop in changed:
+        times = [x for x in sched[last_stop] if x.trip_id not in canceled]
+        times.sort(key=(lambda x: x.arrival_time))
+        sched[last_stop] = times
+    return sched
+
+
 def combine_realtime_with_sched(realtime, stop_ids, gtfs_info, gtfs_sched):
     if not stop_ids:
         return []
-    platform_pair = stop_ids.split("-")  # also works for a single center platform
-    dt = datetime.today()
-    sched = get_sched_for_day(gtfs_info, gtfs_sched, dt.date())
-    feed = gtfs_realtime_pb2.FeedMessage()
+    platform_pair = station_platforms(gtfs_info, stop_ids)
+    dt = current_time()
+    # look back and ahead far enough that late and early trains can still be
+    # matched to realtime, the 1-99 minute filter below trims the rest
+    with timed("schedule"):
+        sched = get_departures_in_window(
+            gtfs_info,
+            gtfs_sched,
+            dt - realtime_lookback,
+            dt + timedelta(minutes=99) + realtime_lookahead,
+        )
     if realtime:
-        feed.ParseFromString(realtime.content)
-        for entity in feed.entity:
-            if entity.HasField("trip_update"):
-                trip_update = entity.trip_update
-                trip_desc = trip_update.trip
-                sched_relation = schedule_relationship[trip_desc.schedule_relationship]
-                stop_updates = list(trip_update.stop_time_update)
-                last_stop = stop_updates[-1].stop_id if len(stop_updates) >= 1 else None
-                if last_stop in sched:  # has realtime update for trip we care about
-                    if sched_relation == "canceled":
-                        # remove from schedule
-                        sched[last_stop] = [
-                            x
-                            for x in sched[last_stop]
-                            if x["trip_id"] != trip_desc.trip_id
-                        ]
-                    else:
-                        for stu in trip_update.stop_time_update:
-                            if stu.stop_id in platform_pair and (
-                                stu.HasField("arrival") or stu.HasField("departure")
-                            ):
-                                if stu.HasField("arrival"):
-                                    used_time = datetime.fromtimestamp(stu.arrival.time)
-                                else:
-                                    used_time = datetime.fromtimestamp(
-                                        stu.departure.time
-                                    )
-                                if sched_relation == "scheduled":
-                                    # replace scheduled time with real time
-                                    sched[last_stop] = [
-                                        (
-                                            {
-                                                "arrival_time": used_time,
-                                                "trip_id": x["trip_id"],
-                                                "service_id": x["service_id"],
-                                                "realtime": True,
-                                            }
-                                            if x["trip_id"] == trip_desc.trip_id
-                                            else x
-                                        )
-                                        for x in sched[last_stop]
-                                    ]
-                                else:
-                                    # insert unscheduled time
-                                    bisect.insort_right(
-                                        sched[last_stop],
-                                        {
-                                            "arrival_time": used_time,
-                                            "trip_id": trip_desc.trip_id,
-                                            "realtime": True,
-                                        },
-                                        key=(lambda x: x["arrival_time"]),
-                                    )
+        updates = parse_realtime_updates(
+            realtime.content, platform_pair, relevant_trip_ids(gtfs_sched)
+        )
+        with timed("merge"):
+            merge_realtime_updates(sched, updates)
     ordered_arr = []
     for dest_id, times in sched.items():
         # Remove times that are not within 1-99 minutes away
@@ -209,11 +866,11 @@ def combine_realtime_with_sched(realtime, stop_ids, gtfs_info, gtfs_sched):
         # so trains that are less than a minute away round up to 1
         filtered_times = [
             {
-                "arrival_time": int(-((x["arrival_time"] - dt).total_seconds() // -60)),
-                "realtime": x["realtime"],
+                "arrival_time": int(-((x.arrival_time - dt).total_seconds() // -60)),
+                "realtime": x.realtime,
             }
             for x in times
-            if 0 < int(-((x["arrival_time"] - dt).total_seconds() // -60)) < 100
+            if 0 < int(-((x.arrival_time - dt).total_seconds() // -60)) < 100
         ]
         if filtered_times:  # not empty
             # sort destinations by which is arriving first
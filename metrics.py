@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+import os
+import resource
+
+"""
+Per-stage timings of the refresh cycle and a few gauges, published in the
+Prometheus text format through arrivals.py --metrics FILE or /metrics with --serve.
+Timings keep a rolling window of the last samples_kept cycles for p50/p95/max.
+"""
+
+samples_kept = 180  # an hour of 20 second refreshes
+# stage: recent durations in seconds
+stage_samples = {}
+# stage: total number of samples ever recorded
+stage_counts = {}
+# (name, labels tuple): value
+gauges = {}
+
+
+def record(stage, seconds):
+    if stage not in stage_samples:
+        stage_samples[stage] = deque(maxlen=samples_kept)
+        stage_counts[stage] = 0
+    stage_samples[stage].append(seconds)
+    stage_counts[stage] += 1
+
+
+@contextmanager
+def timed(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, perf_counter() - start)
+
+
+def set_gauge(name, value, **labels):
+    gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def percentile(sorted_samples, fraction):
+    # nearest rank
+    return sorted_samples[round(fraction * (len(sorted_samples) - 1))]
+
+
+def stage_summary():
+    # {stage: {"p50", "p95", "max", "count"}} over the rolling window
+    summary = {}
+    for stage, samples in stage_samples.items():
+        ordered = sorted(samples)
+        summary[stage] = {
+            "p50": percentile(ordered, 0.5),
+            "p95": percentile(ordered, 0.95),
+            "max": ordered[-1],
+            "count": stage_counts[stage],
+        }
+    return summary
+
+
+def rss_bytes():
+    # current resident set size, falling back to the peak where /proc isn't available
+    try:
+        with open("/proc/self/statm", "r") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def prometheus_text(counters=None):
+    # counters is {name: value} of running totals to publish alongside the stages
+    lines = [
+        "# HELP board_stage_seconds Duration of each refresh stage over the recent window",
+        "# TYPE board_stage_seconds summary",
+    ]
+    for stage, x in stage_summary().items():
+        lines.append(
+            f'board_stage_seconds{{stage="{stage}",quantile="0.5"}} {x["p50"]:.6f}'
+        )
+        lines.append(
+            f'board_stage_seconds{{stage="{stage}",quantile="0.95"}} {x["p95"]:.6f}'
+        )
+        lines.append(f'board_stage_seconds_count{{stage="{stage}"}} {x["count"]}')
+    lines.append("# TYPE board_stage_seconds_max gauge")
+    for stage, x in stage_summary().items():
+        lines.append(f'board_stage_seconds_max{{stage="{stage}"}} {x["max"]:.6f}')
+    lines.append("# TYPE board_rss_bytes gauge")
+    lines.append(f"board_rss_bytes {rss_bytes()}")
+    for (name, labels), value in sorted(gauges.items()):
+        lines.append(f"board_{name}{format_labels(labels)} {value}")
+    for name, value in sorted((counters or {}).items()):
+        lines.append(f"# TYPE board_{name}_total counter")
+        lines.append(f"board_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(path, counters=None):
+    # temp file and rename so a scraper never reads half a file
+    with open(f"{path}.tmp", "w") as outfile:
+        outfile.write(prometheus_text(counters))
+    os.replace(f"{path}.tmp", path)